@@ -2,11 +2,14 @@
 import os
 import sys
 import csv
-import json
+import warnings
+import functools
 import argparse
 import numpy as np
+import orjson
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from opt_einsum import contract
+from numba import njit
 
 # Add agx-emulsion to path
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -27,63 +30,135 @@ except ImportError as e:
     print(f"Failed to import agx modules: {e}")
     sys.exit(1)
 
-def compute_rgb_to_raw_matrix(log_sensitivity_files):
-    # Load sensitivity
+# Target grid for every interpolation, materialised once
+_WAVELENGTHS = np.ascontiguousarray(SPECTRAL_SHAPE.wavelengths, dtype=np.float64)
+
+# Basis and illuminant are stock-independent: materialise them once.
+# Usually we want the matrix to be 'valid' for a reference;
+# agx uses D65 or D55 as reference usually. Let's use D65.
+_D65 = np.ascontiguousarray(standard_illuminant('D65')[:], dtype=np.float64) # [WL]
+_BASIS = np.ascontiguousarray(MALLETT2019_BASIS.values, dtype=np.float64) # [WL, 3]
+
+# Fused _BI[wl, c] = Basis_c(wl) * Illuminant(wl), stored transposed
+_BI_T = np.ascontiguousarray((_BASIS * _D65[:, None]).T) # [3, WL]
+
+def _parse_rows(lines, usecols):
+    # Tolerant per-row parse: skip any row whose fields don't convert
+    rows = []
+    for row in csv.reader(lines):
+        try: rows.append([float(row[c]) for c in usecols] if usecols else [float(x) for x in row])
+        except (ValueError, IndexError): continue
+    width = len(usecols) if usecols else (len(rows[0]) if rows else 2)
+    return np.array([r for r in rows if len(r) == width], dtype=np.float64).reshape(-1, width)
+
+def _load_xy(path, usecols=(0, 1)):
+    # Read once, skip a leading title/header line, and let np.loadtxt parse the
+    # rest in C. Files with garbage further down fall back to the per-row parse.
+    # usecols=None keeps every column.
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    if lines:
+        try: float(lines[0].split(',', 1)[0])
+        except ValueError: lines = lines[1:]
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning) # "input contained no data"
+            return np.loadtxt(lines, delimiter=',', comments='#', usecols=usecols, ndmin=2)
+    except ValueError:
+        return _parse_rows(lines, usecols)
+
+# No fastmath: it assumes no NaNs and would compile the NaN guard away.
+@njit(cache=True)
+def _interp_pow10(x, xp, fp, left, right, log10=False):
+    # np.interp (and optionally nan_to_num(10**y)) fused into one pass over x.
+    # Mirrors np.interp exactly: an on-grid x (including the last of duplicate
+    # xp) returns that node's fp, otherwise y = slope * (x - xp[i]) + fp[i].
+    if xp.shape[0] == 0:
+        raise ValueError("array of sample points is empty")
+    out = np.empty(x.shape[0])
+    idx = np.searchsorted(xp, x, side='right') # xp[i] <= x < xp[i+1]
+    last = xp.shape[0] - 1
+    for j in range(x.shape[0]):
+        i = idx[j] - 1
+        if x[j] < xp[0]:
+            y = left
+        elif x[j] > xp[last]:
+            y = right
+        elif i == last or x[j] == xp[i]:
+            y = fp[i]
+        else:
+            slope = (fp[i+1] - fp[i]) / (xp[i+1] - xp[i])
+            y = slope * (x[j] - xp[i]) + fp[i]
+            if y != y:
+                # If we get nan in one direction, try the other
+                y = slope * (x[j] - xp[i+1]) + fp[i+1]
+                if y != y and fp[i] == fp[i+1]:
+                    y = fp[i]
+        if log10:
+            y = 10.0**y
+            if y != y: y = 0.0
+            elif y > 1.7976931348623157e308: y = 1.7976931348623157e308
+        out[j] = y
+    return out
+
+def _list_dir(path):
+    # One scandir per directory; callers test membership instead of stat-ing
+    # every candidate file with os.path.exists. None if the directory is missing.
+    try:
+        with os.scandir(path) as entries:
+            return {e.name for e in entries}
+    except FileNotFoundError:
+        return None
+
+@functools.lru_cache(maxsize=64)
+def _interp_curves(path, usecols=(0, 1)):
+    # Interp every value column of a CSV to SPECTRAL_SHAPE with CLAMPING
+    # (left=raw[0], right=raw[-1]) -> [WL, n_cols - 1]. Cached because every stock
+    # without its own dyes re-reads the same donor files; the result is shared,
+    # so it is returned read-only.
+    raw = _load_xy(path, usecols)
+    wavelengths = _WAVELENGTHS
+    curves = np.empty((len(wavelengths), raw.shape[1] - 1))
+    for k in range(1, raw.shape[1]):
+        curves[:, k-1] = _interp_pow10(wavelengths, raw[:,0], raw[:,k], raw[0,k], raw[-1,k])
+    curves.flags.writeable = False
+    return curves
+
+def compute_rgb_to_raw_matrix(log_sensitivity):
+    # `log_sensitivity` maps 'r'/'g'/'b' to already parsed [N, 2] (wl, log) arrays
     # We need to interpolate log_sensitivity to SPECTRAL_SHAPE
-    wavelengths = SPECTRAL_SHAPE.wavelengths
-    sensitivities = [] # R, G, B
+    wavelengths = _WAVELENGTHS
+    sensitivity_matrix = np.empty((len(wavelengths), 3)) # [WL, 3] R, G, B
     
-    for channel in ['r', 'g', 'b']:
-        filepath = log_sensitivity_files[channel]
-        if not os.path.exists(filepath):
-            return np.eye(3).tolist() # Fallback
-            
-        data = []
-        with open(filepath, 'r') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                try: 
-                    data.append([float(row[0]), float(row[1])])
-                except: continue
-        data = np.array(data)
+    for i, channel in enumerate(['r', 'g', 'b']):
+        data = log_sensitivity.get(channel)
+        if data is None or len(data) == 0:
+            return np.eye(3, dtype=np.float32) # Fallback
         
         # Interp to standard wavelengths
         # log sensitivity -> sensitivity = 10^log
-        interp_func = np.interp(wavelengths, data[:,0], data[:,1], left=-100, right=-100)
-        sens = 10**interp_func
-        sens = np.nan_to_num(sens)
-        sensitivities.append(sens)
-        
-    sensitivity_matrix = np.stack(sensitivities, axis=1) # [WL, 3]
+        sensitivity_matrix[:, i] = _interp_pow10(wavelengths, data[:,0], data[:,1], -100.0, -100.0, True)
 
     # Compute Matrix
     # Matrix M such that Raw = RGB * M
     # M_ck = sum_lambda (Basis_c(lambda) * Illuminant(lambda) * Sensitivity_k(lambda))
-    
-    illuminant = standard_illuminant('D65')[:] # Standard Camera Illuminant?
-    # Usually we want the matrix to be 'valid' for a reference. 
-    # agx uses D65 or D55 as reference usually. Let's use D65.
-    
-    basis = MALLETT2019_BASIS.values # [WL, 3]
-    
-    # M[c, k] = sum( basis[wl, c] * illuminant[wl] * sensitivity[wl, k] )
-    # contract 'wc, w, wk -> ck'
-    M = contract('wc, w, wk -> ck', basis, illuminant, sensitivity_matrix)
+    # With the fused basis this is a single (3, WL) @ (WL, 3) GEMM.
+    M = _BI_T @ sensitivity_matrix
     
     # Normalize? 
     # agx normalizes so midgray (0.184) gives correct exposure. 
     # But usually the matrix itself is what matters. 
     # Let's keep raw matrix. The simulation engine can normalize exposure gain.
     
-    return M.tolist()
+    # float32 is ample for measured data and halves the JSON payload;
+    # left as an ndarray, orjson serializes it directly
+    return M.astype(np.float32)
 
 
-def load_dye_density(film_dir):
+def load_dye_density(film_dir, present):
     # We need to load C, M, Y, Min, Mid and interpolate them to SPECTRAL_SHAPE
-    wavelengths = SPECTRAL_SHAPE.wavelengths
-    
-    # Define primary locations
-    c_path = os.path.join(film_dir, 'dye_density_c.csv')
+    # `present` is the set of file names in film_dir
+    wavelengths = _WAVELENGTHS
     
     # Generic Donor Path (fallback)
     # Use Vision3 500T as generic donor if local dyes missing
@@ -93,51 +168,32 @@ def load_dye_density(film_dir):
     donor_dir = os.path.join(parent_dir, 'kodak_vision3_500t')
     
     use_donor = False
-    if not os.path.exists(c_path):
-        if os.path.exists(donor_dir):
+    donor_present = None
+    if 'dye_density_c.csv' not in present:
+        donor_present = _list_dir(donor_dir)
+        if donor_present is not None:
             use_donor = True
             # print(f"  Using donor dyes from {os.path.basename(donor_dir)}")
         else:
             # print("  No donor found, using mid/mono approximation")
             pass
 
-    dye_data_cmy = []
+    # [WL, 3] C, M, Y; channels with no data at all stay zero
+    cmy = np.zeros((len(wavelengths), 3))
     
     # Load C, M, Y
-    for chan in ['c', 'm', 'y']:
-        path = os.path.join(film_dir, f'dye_density_{chan}.csv')
-        if use_donor:
-             path = os.path.join(donor_dir, f'dye_density_{chan}.csv')
-        
-        if os.path.exists(path):
-            raw = []
-            with open(path, 'r') as f:
-                for row in csv.reader(f):
-                    try: raw.append([float(row[0]), float(row[1])])
-                    except: continue
-            raw = np.array(raw)
-            # Interp with CLAMPING (left=raw[0], right=raw[-1])
-            # np.interp uses left/right for bounds.
-            interp = np.interp(wavelengths, raw[:,0], raw[:,1], left=raw[0,1], right=raw[-1,1])
-            dye_data_cmy.append(interp)
-        else:
+    for i, chan in enumerate(['c', 'm', 'y']):
+        name = f'dye_density_{chan}.csv'
+        if use_donor and name in donor_present:
+            cmy[:, i] = _interp_curves(os.path.join(donor_dir, name))[:, 0]
+        elif not use_donor and name in present:
+            cmy[:, i] = _interp_curves(os.path.join(film_dir, name))[:, 0]
+        elif 'dye_density_mid.csv' in present:
             # Fallback to mid if even donor fails or for weird reasons
-            mid_path = os.path.join(film_dir, 'dye_density_mid.csv')
-            if os.path.exists(mid_path):
-               raw = []
-               with open(mid_path, 'r') as f:
-                   for row in csv.reader(f):
-                       try: raw.append([float(x) for x in row])
-                       except: continue
-               raw = np.array(raw)
-               # Use 2nd col (val) for all
-               val_col = 1
-               if raw.shape[1] >= 4: val_col = {'c':1, 'm':2, 'y':3}[chan]
-               
-               interp = np.interp(wavelengths, raw[:,0], raw[:,val_col], left=raw[0,val_col], right=raw[-1,val_col])
-               dye_data_cmy.append(interp)
-            else:
-               dye_data_cmy.append(np.zeros_like(wavelengths))
+            # Parsed once with all columns: (wl, c, m, y) gives per-channel
+            # curves, otherwise use 2nd col (val) for all
+            mid = _interp_curves(os.path.join(film_dir, 'dye_density_mid.csv'), usecols=None)
+            cmy[:, i] = mid[:, i] if mid.shape[1] >= 3 else mid[:, 0]
 
     # Load Base / Min Density
     # Usually 'dye_density_min.csv'
@@ -145,34 +201,17 @@ def load_dye_density(film_dir):
     # Usually Base is specific to stock (acetate/polyester base color).
     # Try local min, then donor min.
     
-    min_path = os.path.join(film_dir, 'dye_density_min.csv')
-    if not os.path.exists(min_path) and use_donor:
-        min_path = os.path.join(donor_dir, 'dye_density_min.csv')
-        
     dye_data_base = np.zeros_like(wavelengths)
-    if os.path.exists(min_path):
-       raw = []
-       with open(min_path, 'r') as f:
-            for row in csv.reader(f):
-                try: raw.append([float(row[0]), float(row[1])])
-                except: continue
-       raw = np.array(raw)
-       dye_data_base = np.interp(wavelengths, raw[:,0], raw[:,1], left=raw[0,1], right=raw[-1,1])
-
-    # Combine
-    combined = []
-    for i in range(len(wavelengths)):
-        row = [wavelengths[i]]
-        # C, M, Y
-        for d in dye_data_cmy:
-            row.append(d[i])
-        # Base
-        row.append(dye_data_base[i])
-        combined.append(row)
-        
-    return combined
+    if 'dye_density_min.csv' in present:
+       dye_data_base = _interp_curves(os.path.join(film_dir, 'dye_density_min.csv'))[:, 0]
+    elif use_donor and 'dye_density_min.csv' in donor_present:
+       dye_data_base = _interp_curves(os.path.join(donor_dir, 'dye_density_min.csv'))[:, 0]
+
+    # Combine into [WL, C, M, Y, Base] rows, the layout the engine indexes per
+    # wavelength. Left as a float32 ndarray; orjson serializes it directly.
+    return np.column_stack([wavelengths, cmy, dye_data_base]).astype(np.float32)
 
-def create_profile_skeleton(slug, film_dir):
+def create_profile_skeleton(slug, film_dir, present, log_sensitivity):
     name = slug.replace('_', ' ').title()
     manufacturer = 'Unknown'
     if 'kodak' in slug: manufacturer = 'Kodak'
@@ -189,15 +228,10 @@ def create_profile_skeleton(slug, film_dir):
     if 'ilford' in slug or 'tmax' in slug or 'tri-x' in slug: process = 'BW'
     
     # Matrix Calc
-    log_sens_files = {
-        'r': os.path.join(film_dir, 'log_sensitivity_r.csv'),
-        'g': os.path.join(film_dir, 'log_sensitivity_g.csv'),
-        'b': os.path.join(film_dir, 'log_sensitivity_b.csv')
-    }
-    rgb_to_raw = compute_rgb_to_raw_matrix(log_sens_files)
+    rgb_to_raw = compute_rgb_to_raw_matrix(log_sensitivity)
     
     # Dye Density
-    dye_density = load_dye_density(film_dir)
+    dye_density = load_dye_density(film_dir, present)
     
     return {
       "id": slug,
@@ -215,48 +249,53 @@ def create_profile_skeleton(slug, film_dir):
       "spectral": { "red": [], "green": [], "blue": [] }
     }
 
-def read_csv_points(filepath):
-    points = []
-    if not os.path.exists(filepath):
-        return []
+def read_csv_array(filepath):
     try:
-        with open(filepath, 'r') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if len(row) >= 2:
-                    try:
-                        x = float(row[0].strip())
-                        y = float(row[1].strip())
-                        points.append({"x": x, "y": y})
-                    except ValueError:
-                        continue
+        return _load_xy(filepath)
     except Exception as e:
         print(f"Error reading {filepath}: {e}")
-    return points
+        return np.empty((0, 2))
+
+def to_points(data):
+    # Keep the {x, y} Point schema consumed by the simulation engine
+    return [{"x": x, "y": y} for x, y in data.tolist()]
+
+def read_csv_points(filepath):
+    return to_points(read_csv_array(filepath))
 
 def process_film_dir(film_dir, output_dir):
     slug = os.path.basename(film_dir)
-    profile = create_profile_skeleton(slug, film_dir)
+    present = _list_dir(film_dir)
 
-    # Sensitometry
-    profile['sensitometry']['red'] = read_csv_points(os.path.join(film_dir, 'density_curve_r.csv'))
-    profile['sensitometry']['green'] = read_csv_points(os.path.join(film_dir, 'density_curve_g.csv'))
-    profile['sensitometry']['blue'] = read_csv_points(os.path.join(film_dir, 'density_curve_b.csv'))
+    # Sensitometry first: stocks without a red density curve are skipped,
+    # so don't pay for the matrix and dye interpolations on them.
+    sensitometry = { "red": [], "green": [], "blue": [] }
+    for key, chan in [('red', 'r'), ('green', 'g'), ('blue', 'b')]:
+        if f'density_curve_{chan}.csv' in present:
+            sensitometry[key] = read_csv_points(os.path.join(film_dir, f'density_curve_{chan}.csv'))
 
-    # Spectral
-    profile['spectral']['red'] = read_csv_points(os.path.join(film_dir, 'log_sensitivity_r.csv'))
-    profile['spectral']['green'] = read_csv_points(os.path.join(film_dir, 'log_sensitivity_g.csv'))
-    profile['spectral']['blue'] = read_csv_points(os.path.join(film_dir, 'log_sensitivity_b.csv'))
-    
-    has_sens = len(profile['sensitometry']['red']) > 0
-    
-    if has_sens:
-        output_file = os.path.join(output_dir, f"{slug}.json")
-        with open(output_file, 'w') as f:
-            json.dump(profile, f, indent=2)
-        print(f"Imported {slug} with Physics Data")
-    else:
+    has_sens = len(sensitometry['red']) > 0
+    if not has_sens:
         print(f"Skipping {slug}")
+        return
+
+    # Parsed once, shared by the matrix calc and the spectral block
+    log_sensitivity = {
+        chan: read_csv_array(os.path.join(film_dir, f'log_sensitivity_{chan}.csv'))
+        for chan in ['r', 'g', 'b'] if f'log_sensitivity_{chan}.csv' in present
+    }
+    profile = create_profile_skeleton(slug, film_dir, present, log_sensitivity)
+    profile['sensitometry'] = sensitometry
+
+    # Spectral
+    for key, chan in [('red', 'r'), ('green', 'g'), ('blue', 'b')]:
+        if chan in log_sensitivity:
+            profile['spectral'][key] = to_points(log_sensitivity[chan])
+
+    output_file = os.path.join(output_dir, f"{slug}.json")
+    with open(output_file, 'wb') as f:
+        f.write(orjson.dumps(profile, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    print(f"Imported {slug} with Physics Data")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -267,6 +306,14 @@ if __name__ == "__main__":
     if not os.path.exists(args.output):
         os.makedirs(args.output)
 
-    for root, dirs, files in os.walk(args.input_dir):
-        if any(f.endswith('density_curve_r.csv') for f in files):
-            process_film_dir(root, args.output)
+    film_dirs = [
+        root for root, dirs, files in os.walk(args.input_dir)
+        if 'density_curve_r.csv' in files
+    ]
+
+    # Stocks are independent (own CSVs, own JSON), so process them in parallel.
+    # Module-level state (_BI_T, basis) is inherited under fork and rebuilt on
+    # import under spawn. The donor lru_cache is per worker, so each worker
+    # parses the donor files at most once.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(functools.partial(process_film_dir, output_dir=args.output), film_dirs))